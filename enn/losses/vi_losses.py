@@ -175,7 +175,7 @@ def get_diagonal_linear_hypermodel_elbo_fn(
     biases = jnp.concatenate(biases, axis=0)
     weights, _ = jax.tree_flatten(weights)
     weights = jnp.concatenate(weights, axis=0)
-    scales = jnp.log(1 + jnp.exp(weights))
+    scales = jax.nn.softplus(weights)
     chex.assert_equal_shape([scales, biases])
     return 0.5  / num_samples * (
         jnp.sum(jnp.square(scales))
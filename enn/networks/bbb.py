@@ -80,10 +80,14 @@ class DiagonalLinearHypermodel(base.EpistemicNetwork):
       b_init: Optional[hk.initializers.Initializer] = None,
       ):
 
-    base_params = transformed_base.init(jax.random.PRNGKey(0), dummy_input)
+    base_params = jax.eval_shape(
+        transformed_base.init, jax.random.PRNGKey(0), dummy_input)
     num_base_params = np.sum(
-        jax.tree_leaves(jax.tree_map(np.size, base_params)))
+        [np.prod(x.shape, dtype=int) for x in jax.tree_leaves(base_params)])
     indexer = indexer_ctor(num_base_params)
+    # The diagonal hypermodel needs one index dimension per base param.
+    index_shape = jax.eval_shape(indexer, jax.random.PRNGKey(0)).shape
+    chex.assert_equal(index_shape, (num_base_params,))
 
     enn = utils.epistemic_network_from_module(
         enn_ctor=hypermodels.hypermodel_module(
@@ -17,9 +17,8 @@
 
 """Prototype for linear hypermodel in JAX."""
 
-from typing import Callable, Optional, Sequence, Type
+from typing import Callable, Optional, Sequence, Tuple, Type
 
-import chex
 from enn import base
 from enn import utils
 from enn.networks import priors
@@ -29,11 +28,6 @@ import jax.numpy as jnp
 import numpy as np
 
 
-# TODO(author2): Current implementation will produce a hypermodel that can
-# *only* work for a single index at a time. However, note that jax.vmap means
-# this can easily be converted into a form that works with batched index.
-
-
 class MLPHypermodel(base.EpistemicNetwork):
   """MLP hypermodel for transformed_base as EpistemicNetwork."""
 
@@ -46,14 +40,30 @@ class MLPHypermodel(base.EpistemicNetwork):
                scale: bool = True,
                w_init: Optional[hk.initializers.Initializer] = None,
                b_init: Optional[hk.initializers.Initializer] = None,
+               batched_index: bool = False,
+               hyper_torso: Optional[Callable[[base.Index], base.Array]] = None,
                ):
-    """MLP hypermodel for transformed_base as EpistemicNetwork."""
+    """MLP hypermodel for transformed_base as EpistemicNetwork.
 
-    if hidden_sizes is None:
-      hyper_torso = lambda x: x
-    else:
-      def hyper_torso(index):
-        return hk.nets.MLP(hidden_sizes, w_init=w_init, b_init=b_init)(index)
+    If batched_index is True, the index has shape [num_index, index_dim] (e.g.
+    from utils.make_batch_indexer) and all indices are forwarded in one call.
+
+    If hyper_torso is given, it is used to transform the index instead of an
+    MLP with hidden_sizes, w_init and b_init. It is called inside the hypermodel
+    module, so any haiku modules it creates are part of the hypermodel params.
+    """
+
+    if hyper_torso is not None and (hidden_sizes is not None or
+                                    w_init is not None or b_init is not None):
+      raise ValueError('hyper_torso cannot be combined with hidden_sizes, '
+                       'w_init or b_init.')
+
+    if hyper_torso is None:
+      if hidden_sizes is None:
+        hyper_torso = lambda x: x
+      else:
+        def hyper_torso(index):
+          return hk.nets.MLP(hidden_sizes, w_init=w_init, b_init=b_init)(index)
 
     enn = utils.epistemic_network_from_module(
         enn_ctor=hypermodel_module(
@@ -61,7 +71,8 @@ class MLPHypermodel(base.EpistemicNetwork):
             dummy_input,
             hyper_torso,
             return_generated_params=return_generated_params,
-            scale=scale),
+            scale=scale,
+            batched_index=batched_index),
         indexer=indexer,
     )
     super().__init__(enn.apply, enn.init, enn.indexer)
@@ -75,6 +86,7 @@ def hypermodel_module(
     diagonal_linear_hyper: bool = False,
     return_generated_params: bool = False,
     scale: bool = True,
+    batched_index: bool = False,
 ) -> Type[base.EpistemicModule]:
   """Generates an haiku module for a hypermodel of a transformed base network.
 
@@ -88,8 +100,8 @@ def hypermodel_module(
   base model. Now, since the weights of the base model are generated by the
   hypermodel's output, we can manually scale the generated weights. Note that
   this scaling is needed only for the weight parameters and not for bias
-  parameters. Function `scale_fn` appropriately scales the weights generated by
-  the hypermodel.
+  parameters. Function `scale_fn` gives the appropriate scale of the weights
+  generated by the hypermodel.
 
   Args:
     transformed_base: hk.transformed_without_rng of base model y = f_theta(x).
@@ -100,18 +112,29 @@ def hypermodel_module(
       to the transformed index is diagonal linear or linear.
     return_generated_params: returns generated params in addition to output.
     scale: a boolean specifying whether to scale the params or not.
+    batched_index: whether the index has a leading batch dimension. If True,
+      the params for all indices are generated together and the base model is
+      vmapped over them, giving outputs with a leading num_index dimension.
 
   Returns:
-    Hypermodel of the "base model" as ctor for EpistemicModule. Should be used
-    with only *one* epistemic index at a time (can vmap for batch).
+    Hypermodel of the "base model" as ctor for EpistemicModule.
   """
-  base_params = transformed_base.init(jax.random.PRNGKey(0), dummy_input)
-  base_params_flat = jax.tree_map(jnp.ravel, base_params)
-  base_shapes = jax.tree_map(lambda x: jnp.array(jnp.shape(x)), base_params)
-  base_shapes_flat = jax.tree_map(len, base_params_flat)
+  # Only the shapes of the base params are needed, so avoid initializing them.
+  base_params = jax.eval_shape(
+      transformed_base.init, jax.random.PRNGKey(0), dummy_input)
+
+  # Precompute the flat layout of the base params once so that hyper_fn does
+  # not need to walk the param tree every time it is called.
+  base_treedef = jax.tree_structure(base_params)
+  base_shapes = [tuple(x.shape) for x in jax.tree_leaves(base_params)]
+  base_sizes = [int(np.prod(shape)) for shape in base_shapes]
+  split_indices = np.cumsum(base_sizes)[:-1].tolist()
+  num_base_params = sum(base_sizes)
+  # Number of leading batch dimensions of the index and generated params.
+  num_batch_dims = 1 if batched_index else 0
 
   def scale_fn(module_name, name, value):
-    """Scales weight by 1/sqrt(fan_in) and leaves biases unchanged.
+    """Returns 1/sqrt(fan_in) for weights and 1 for biases.
 
     Args:
       module_name: (typically) layer name. Not used but is needed for hk.map.
@@ -119,50 +142,68 @@ def hypermodel_module(
       value: value of the parameters.
 
     Returns:
-      scaled parameters suitable for use in the apply function of base network.
+      scale of the parameters suitable for use in the apply function of base
+      network.
     """
     del module_name
     # The parameter name can be either 'w' (if the parameter is a weight)
     # or 'b' (if the parameter is a bias)
-    return value / jnp.sqrt(value.shape[0]) if name == 'w' else value
+    return 1. / np.sqrt(value.shape[0]) if name == 'w' else 1.
+
+  # Since the base shapes are known, scaling the generated params is a single
+  # multiply of the flat hypermodel output by this vector.
+  base_scales = jax.tree_leaves(hk.data_structures.map(scale_fn, base_params))
+  scale_vector = np.concatenate([
+      np.full(size, param_scale)
+      for size, param_scale in zip(base_sizes, base_scales)
+  ])
+
+  def unflatten(flat_params: base.Array) -> hk.Params:
+    """Splits and reshapes flat params into the base param tree."""
+    # The leading batch dimensions of the index are kept.
+    batch_shape = flat_params.shape[:num_batch_dims]
+    flat_output = jnp.split(flat_params, split_indices, axis=-1)
+    return jax.tree_unflatten(base_treedef, [
+        jnp.reshape(x, batch_shape + shape)
+        for x, shape in zip(flat_output, base_shapes)
+    ])
 
   def hyper_fn(inputs: base.Array, index: base.Index) -> base.Array:
 
     if diagonal_linear_hyper:
-      # index must be the same size as the total number of base params.
-      chex.assert_shape(index, (np.sum(jax.tree_leaves(base_shapes_flat)),))
-
+      # index must be the same size as the total number of base params. This
+      # is checked statically by the caller, e.g. DiagonalLinearHypermodel.
       hyper_index = DiagonalLinear()(index)
-      flat_output = jnp.split(
-          hyper_index, np.cumsum(jax.tree_leaves(base_shapes_flat))[:-1])
-      flat_output = jax.tree_unflatten(jax.tree_structure(base_shapes),
-                                       flat_output)
     else:
       # Apply the hyper_torso to the epistemic index
       hyper_index = hyper_torso(index)
 
-      # Generate a linear layer of size "base_shapes_flat"
-      final_layers = jax.tree_map(hk.Linear, base_shapes_flat)
-
-      # Apply this linear output to the output of the hyper_torso
-      flat_output = jax.tree_map(lambda layer: layer(hyper_index), final_layers)
-
-    # Reshape this flattened output to the original base shapes (unflatten)
-    generated_params = jax.tree_multimap(jnp.reshape, flat_output, base_shapes)
+      # Generate all of the flattened base params with a single linear layer
+      hyper_index = hk.Linear(num_base_params)(hyper_index)
 
     if scale:
       # Scale the generated params such that expected variance of the raw
       # generated params is O(1) for both bias and weight parameters.
-      generated_params_scaled = hk.data_structures.map(scale_fn,
-                                                       generated_params)
+      hyper_index_scaled = hyper_index * jnp.asarray(
+          scale_vector, dtype=hyper_index.dtype)
     else:
-      generated_params_scaled = generated_params
+      hyper_index_scaled = hyper_index
+
+    # Reshape this flattened output to the original base shapes (unflatten)
+    generated_params_scaled = unflatten(hyper_index_scaled)
 
     # Output the original base function(inputs) with these generated params
-    out = transformed_base.apply(generated_params_scaled, inputs)
+    if batched_index:
+      base_apply = jax.vmap(transformed_base.apply, in_axes=(0, None))
+    else:
+      base_apply = transformed_base.apply
+    out = base_apply(generated_params_scaled, inputs)
     if return_generated_params:
+      # The unscaled params are only unflattened when they are returned.
+      generated_params = (
+          unflatten(hyper_index) if scale else generated_params_scaled)
       out = base.OutputWithPrior(
-          train=transformed_base.apply(generated_params_scaled, inputs),
+          train=out,
           extra={
               'hyper_net_out': generated_params,
               'base_net_params': generated_params_scaled
@@ -215,8 +256,10 @@ class MLPHypermodelWithHypermodelPrior(base.EpistemicNetwork):
         b_init=b_init,
         scale=scale,
     )
-    prior_fn = priors.convert_enn_to_prior_fn(
-        prior_enn, dummy_input, jax.random.PRNGKey(seed))
+    # The prior is fixed, so it is jitted once here rather than retraced with
+    # every function that forwards it.
+    prior_fn = jax.jit(priors.convert_enn_to_prior_fn(
+        prior_enn, dummy_input, jax.random.PRNGKey(seed)))
 
     # Defining an ENN without any prior function
     enn_wo_prior = MLPHypermodel(
@@ -241,8 +284,30 @@ class MLPHypermodelWithHypermodelPrior(base.EpistemicNetwork):
 # are generated by different set of indices.
 
 
+def _normalized_init(scaling: float,
+                     shift: float = 0.) -> hk.initializers.Initializer:
+  """Random normal init normalized along the last (index) axis.
+
+  Args:
+    scaling: variance of the initialized params after normalization.
+    shift: constant added to the initialized params.
+
+  Returns:
+    Initializer with params of norm sqrt(scaling) along the last axis.
+  """
+  def init(shape, dtype):
+    x = hk.initializers.RandomNormal()(shape, dtype)
+    x *= jax.lax.rsqrt(jnp.sum(jnp.square(x), axis=-1, keepdims=True) + 1e-12)
+    return x * jnp.sqrt(scaling) + shift
+  return init
+
+
 class HyperLinear(hk.Module):
-  """Linear hypermodel."""
+  """Linear hypermodel.
+
+  The params are normalized and scaled once at init rather than on every
+  forward pass, since HyperLinear is only used for fixed prior functions.
+  """
 
   def __init__(self,
                output_size: int,
@@ -260,23 +325,29 @@ class HyperLinear(hk.Module):
 
   def __call__(self, x: base.Array, z: base.Index) -> base.Array:
     unused_x_batch_size, hidden_size = x.shape
-    init = hk.initializers.RandomNormal()
+    w, b = self.get_params(hidden_size)
+    return _hyper_linear(w, b, x, z)
+
+  def get_params(self, hidden_size: int) -> Tuple[base.Array, base.Array]:
+    """Returns the weight and bias params for inputs of size hidden_size."""
     w = hk.get_parameter(
         'w', [self._output_size, hidden_size, self._index_dim_per_layer],
-        init=init)
+        init=_normalized_init(self._weight_scaling / hidden_size))
     b = hk.get_parameter(
-        'b', [self._output_size, self._index_dim_per_layer], init=init)
-
-    w /= jnp.linalg.norm(w, axis=-1, keepdims=True)
-    b /= jnp.linalg.norm(b, axis=-1, keepdims=True)
+        'b', [self._output_size, self._index_dim_per_layer],
+        init=_normalized_init(self._bias_scaling, self._fixed_bias_val))
+    return w, b
 
-    w *= jnp.sqrt(self._weight_scaling / hidden_size)
-    b = b * jnp.sqrt(self._bias_scaling) + self._fixed_bias_val
 
-    weights = jnp.einsum('ohi,i->oh', w, z)
-    bias = jnp.einsum('oi,i->o', b, z)
+def _hyper_linear(w: base.Array, b: base.Array,
+                  x: base.Array, z: base.Index) -> base.Array:
+  """Forwards x through the linear layer with params generated from z."""
+  # Contracting w with z and x in a single einsum lets XLA pick the best
+  # contraction order without materializing the [O, H] weight matrix.
+  out = jnp.einsum('ohi,i,bh->bo', w, z, x, optimize='optimal')
+  bias = jnp.einsum('oi,i->o', b, z)
 
-    return jnp.einsum('oh,bh->bo', weights, x) + bias
+  return out + bias
 
 
 class PriorMLPIndependentLayers(hk.Module):
@@ -297,21 +368,31 @@ class PriorMLPIndependentLayers(hk.Module):
     self._bias_scaling = bias_scaling
     self._fixed_bias_val = fixed_bias_val
 
+    # Only the sizes of the index chunks are needed here, so use numpy to keep
+    # construction free of any device computation.
     if self._index_dim < self._num_layers:
       # Assigning all index dimensions to all layers
-      self._layers_indices = [jnp.arange(self._index_dim)] * self._num_layers
+      self._layers_indices = [np.arange(self._index_dim)] * self._num_layers
 
     else:
       # Spliting index dimension into num_layers chunks
-      self._layers_indices = jnp.array_split(
-          jnp.arange(self._index_dim), self._num_layers)
+      self._layers_indices = np.array_split(
+          np.arange(self._index_dim), self._num_layers)
+
+    # If all hidden layers have the same output size and the layers between
+    # the first and the last have the same index dimension, the params of these
+    # intermediate layers are stacked and applied with a single scan.
+    index_dims = [len(layer_indices) for layer_indices in self._layers_indices]
+    self._split_indices = np.cumsum(index_dims)[:-1].tolist()
+    self._stacked = (self._num_layers > 3
+                     and len(set(self._output_sizes[:-1])) == 1
+                     and len(set(index_dims[1:-1])) == 1)
 
     # Defining layers of the prior MLP and associating each layer with a set of
     # indices
     self._layers = []
-    for layer_indices, output_size in zip(self._layers_indices,
-                                          self._output_sizes):
-      index_dim_per_layer = len(layer_indices)
+    for index_dim_per_layer, output_size in zip(index_dims,
+                                                self._output_sizes):
       layer = HyperLinear(output_size, index_dim_per_layer,
                           self._weight_scaling, self._bias_scaling,
                           self._fixed_bias_val)
@@ -322,8 +403,26 @@ class PriorMLPIndependentLayers(hk.Module):
       # Assigning all index dimensions to all layers
       index_layers = [z] * self._num_layers
     else:
-      # Spliting index dimension into num_layers chunks
-      index_layers = jnp.array_split(z, self._num_layers)
+      # Spliting index dimension into num_layers chunks at static positions
+      index_layers = jnp.split(z, self._split_indices)
+
+    if self._stacked:
+      first_layer, *hidden_layers, last_layer = self._layers
+      out = jax.nn.relu(first_layer(x, index_layers[0]))
+
+      # Each hidden layer keeps its own params, created in the same order as
+      # in the loop below, so the prior does not depend on the stacking.
+      _, hidden_size = out.shape
+      hidden_params = [layer.get_params(hidden_size) for layer in hidden_layers]
+      hidden_w, hidden_b = [jnp.stack(p) for p in zip(*hidden_params)]
+
+      def layer_fn(out, layer_params):
+        layer_w, layer_b, layer_z = layer_params
+        return jax.nn.relu(_hyper_linear(layer_w, layer_b, out, layer_z)), None
+
+      out, _ = jax.lax.scan(
+          layer_fn, out, (hidden_w, hidden_b, jnp.stack(index_layers[1:-1])))
+      return last_layer(out, index_layers[-1])
 
     out = x
     for i, layer in enumerate(self._layers):
@@ -352,9 +451,15 @@ class MLPHypermodelPriorIndependentLayers(base.EpistemicNetwork):
                prior_fixed_bias_val: float = 0.0,
                seed: int = 0,
                scale: bool = True,
-               problem_temperature: Optional[float] = None
+               problem_temperature: Optional[float] = None,
+               prior_dtype: Optional[jnp.dtype] = None,
                ):
-    """MLP hypermodel with hypermodel prior as EpistemicNetwork."""
+    """MLP hypermodel with hypermodel prior as EpistemicNetwork.
+
+    If prior_dtype is given (e.g. jnp.bfloat16), the frozen prior params are
+    stored and forwarded in that dtype, and the prior output is cast back to
+    the dtype of the inputs.
+    """
 
     # Making the base model for the ENN without any prior function
     def base_net(x):
@@ -368,9 +473,8 @@ class MLPHypermodelPriorIndependentLayers(base.EpistemicNetwork):
     # Defining an ENN for the prior function based on an MLP with independent
     # layers which divides index dimension among the MLP layers. To this end, we
     # need to find the index dimension.
-    rng = hk.PRNGSequence(seed)
-    index = indexer(next(rng))
-    index_dim, = index.shape
+    index_spec = jax.eval_shape(indexer, jax.random.PRNGKey(seed))
+    index_dim, = index_spec.shape
     def prior_net(x, z):
       net_out = PriorMLPIndependentLayers(
           output_sizes=prior_base_output_sizes,
@@ -384,11 +488,41 @@ class MLPHypermodelPriorIndependentLayers(base.EpistemicNetwork):
 
     prior_enn = hk.without_apply_rng(hk.transform(prior_net))
 
-    # Initializing prior ENN to get `prior_fn(x, z)` which forwards prior ENN
-    rng = hk.PRNGSequence(seed)
-    prior_params = prior_enn.init(next(rng), dummy_input, index)
+    # Initializing prior ENN to get `prior_fn(x, z)` which forwards prior ENN.
+    # This is deferred until the prior params are first needed, normally by the
+    # init of the ENN below, so that the constructor does no device work.
+    prior_params_cache = []
+
+    def get_prior_params() -> hk.Params:
+      if prior_params_cache:
+        return prior_params_cache[0]
+      # The prior params are always computed eagerly, even when first needed
+      # inside a jax transform, so that they are concrete and can be cached
+      # rather than compiling the prior init into every forward pass.
+      with jax.ensure_compile_time_eval():
+        # The prior params only depend on the shape of the index, not its
+        # value.
+        index = jnp.zeros(index_spec.shape, index_spec.dtype)
+        prior_params = prior_enn.init(
+            next(hk.PRNGSequence(seed)), dummy_input, index)
+        if prior_dtype is not None:
+          # The prior is only ever forwarded, so lower precision params are
+          # enough for a random additive prior function.
+          prior_params = jax.tree_map(
+              lambda x: x.astype(prior_dtype), prior_params)
+      prior_params_cache.append(prior_params)
+      return prior_params
+
     def prior_fn(x, z):
-      return prior_enn.apply(prior_params, x, z)
+      prior_params = get_prior_params()
+      if prior_dtype is None:
+        return prior_enn.apply(prior_params, x, z)
+      prior_out = prior_enn.apply(
+          prior_params, x.astype(prior_dtype), z.astype(prior_dtype))
+      return prior_out.astype(x.dtype)
+    # The prior is fixed, so it is jitted once here rather than retraced with
+    # every function that forwards it.
+    prior_fn = jax.jit(prior_fn)
 
     # Defining an ENN without any prior function
     enn_wo_prior = MLPHypermodel(
@@ -405,7 +539,11 @@ class MLPHypermodelPriorIndependentLayers(base.EpistemicNetwork):
     enn = priors.EnnWithAdditivePrior(
         enn_wo_prior, prior_fn, prior_scale=prior_scale)
 
-    super().__init__(enn.apply, enn.init, enn.indexer)
+    def init(key: base.RngKey, x: base.Array, z: base.Index) -> hk.Params:
+      get_prior_params()
+      return enn.init(key, x, z)
+
+    super().__init__(enn.apply, init, enn.indexer)
 
 
 class DiagonalLinear(hk.Module):
@@ -447,7 +585,7 @@ class DiagonalLinear(hk.Module):
       w_init = hk.initializers.TruncatedNormal(stddev=stddev)
     w = hk.get_parameter('w', [self.input_size], dtype, init=w_init)
 
-    out = inputs * jnp.log(1 + jnp.exp(w))
+    out = inputs * jax.nn.softplus(w)
 
     if self.with_bias:
       b = hk.get_parameter('b', [self.input_size], dtype, init=self.b_init)
@@ -16,14 +16,18 @@
 # ============================================================================
 
 """Tests for ENN Hypermodels."""
-from typing import List
+from typing import List, Optional
 
 from absl.testing import absltest
 from absl.testing import parameterized
 from enn import supervised
+from enn import utils
 from enn.networks import hypermodels
 from enn.networks import indexers
 import haiku as hk
+import jax
+import jax.numpy as jnp
+import numpy as np
 
 
 class MLPHypermodelTest(parameterized.TestCase):
@@ -56,6 +60,88 @@ class MLPHypermodelTest(parameterized.TestCase):
     experiment = test_experiment.experiment_ctor(enn)
     experiment.train(10)
 
+  @parameterized.parameters([
+      ([], [], 4),
+      ([3], [], 5),
+      ([3, 7], [4], 3),
+  ])
+  def test_batched_index(self, model_hiddens: List[int],
+                         hyper_hiddens: List[int], index_dim: int):
+    """Batched index output matches forwarding each index separately."""
+    num_index = 6
+    dummy_input = jax.random.normal(jax.random.PRNGKey(0), [10, 3])
+
+    def base_net(x):
+      return hk.nets.MLP(model_hiddens + [2])(x)
+
+    transformed_base = hk.without_apply_rng(hk.transform(base_net))
+
+    indexer = indexers.ScaledGaussianIndexer(index_dim, index_scale=1.0)
+    enn = hypermodels.MLPHypermodel(
+        transformed_base=transformed_base,
+        dummy_input=dummy_input,
+        indexer=indexer,
+        hidden_sizes=hyper_hiddens,
+    )
+    batched_enn = hypermodels.MLPHypermodel(
+        transformed_base=transformed_base,
+        dummy_input=dummy_input,
+        indexer=utils.make_batch_indexer(indexer, num_index),
+        hidden_sizes=hyper_hiddens,
+        batched_index=True,
+    )
+
+    rng = hk.PRNGSequence(0)
+    batched_index = batched_enn.indexer(next(rng))
+    params = enn.init(next(rng), dummy_input, batched_index[0])
+
+    batched_out = batched_enn.apply(params, dummy_input, batched_index)
+    single_out = jax.vmap(enn.apply, in_axes=[None, None, 0])(
+        params, dummy_input, batched_index)
+    np.testing.assert_allclose(batched_out, single_out, rtol=1e-5, atol=1e-5)
+
+  def test_custom_hyper_torso(self):
+    """Make sure a custom hyper_torso is part of the hypermodel params."""
+    dummy_input = jax.random.normal(jax.random.PRNGKey(0), [10, 3])
+
+    def base_net(x):
+      return hk.nets.MLP([3, 2])(x)
+
+    transformed_base = hk.without_apply_rng(hk.transform(base_net))
+
+    def hyper_torso(index):
+      return hk.Linear(6, name='custom_torso')(index)
+
+    indexer = indexers.ScaledGaussianIndexer(4, index_scale=1.0)
+    enn = hypermodels.MLPHypermodel(
+        transformed_base=transformed_base,
+        dummy_input=dummy_input,
+        indexer=indexer,
+        hyper_torso=hyper_torso,
+    )
+    rng = hk.PRNGSequence(0)
+    index = enn.indexer(next(rng))
+    params = enn.init(next(rng), dummy_input, index)
+    self.assertIn('hyper_fn/custom_torso', params)
+
+    # Changing the torso params changes the output of the hypermodel.
+    def perturb_torso(module_name, name, value):
+      del name
+      return value + 1. if module_name == 'hyper_fn/custom_torso' else value
+    perturbed_params = hk.data_structures.map(perturb_torso, params)
+    self.assertFalse(np.allclose(
+        enn.apply(params, dummy_input, index),
+        enn.apply(perturbed_params, dummy_input, index)))
+
+    with self.assertRaises(ValueError):
+      hypermodels.MLPHypermodel(
+          transformed_base=transformed_base,
+          dummy_input=dummy_input,
+          indexer=indexer,
+          hidden_sizes=[6],
+          hyper_torso=hyper_torso,
+      )
+
   @parameterized.parameters([
       ([], [], [], [], 0.0, 4, True),
       ([3], [], [4], [], 1.0, 4, True),
@@ -92,10 +178,12 @@ class MLPHypermodelTest(parameterized.TestCase):
       ([3], [], [2, 2], 1.0, 1, True),
       ([3], [], [2, 2], 1.0, 3, True),
       ([3], [], [2, 2], 1.0, 5, True),
+      ([3], [], [2, 2, 2], 1.0, 8, True),
       ([], [], [2], 0.0, 4, False),
       ([3], [], [2, 2], 1.0, 1, False),
       ([3], [], [2, 2], 1.0, 3, False),
       ([3], [], [2, 2], 1.0, 5, False),
+      ([3], [], [2, 2, 2], 1.0, 8, False),
   ])
   def test_hyper_prior_independent_layers(self, model_hiddens: List[int],
                                           hyper_hiddens: List[int],
@@ -118,6 +206,98 @@ class MLPHypermodelTest(parameterized.TestCase):
     experiment = test_experiment.experiment_ctor(enn)
     experiment.train(10)
 
+  def test_jitted_init_keeps_prior_params_concrete(self):
+    """Make sure a jitted init does not compile the prior init into apply."""
+    dummy_input = jax.random.normal(jax.random.PRNGKey(0), [10, 3])
+    indexer = indexers.ScaledGaussianIndexer(4, index_scale=1.0)
+    enn = hypermodels.MLPHypermodelPriorIndependentLayers(
+        base_output_sizes=[2],
+        prior_scale=1.0,
+        dummy_input=dummy_input,
+        indexer=indexer,
+        prior_base_output_sizes=[3, 3, 3, 2])
+    index = indexer(jax.random.PRNGKey(1))
+    params = jax.jit(enn.init)(jax.random.PRNGKey(2), dummy_input, index)
+
+    apply_jaxpr = str(jax.make_jaxpr(enn.apply)(params, dummy_input, index))
+    for random_op in ['threefry', 'random_bits']:
+      self.assertNotIn(random_op, apply_jaxpr)
+
+  @parameterized.parameters([
+      ([2], 4),
+      ([5, 5, 5], 8),
+  ])
+  def test_low_precision_prior(self, prior_hiddens: List[int], index_dim: int):
+    """Make sure a bfloat16 prior keeps the moments of the float32 prior."""
+    num_index = 1000
+    dummy_input = jax.random.normal(jax.random.PRNGKey(0), [10, 3])
+    indexer = indexers.ScaledGaussianIndexer(index_dim, index_scale=1.0)
+    indices = utils.make_batch_indexer(indexer, num_index)(
+        jax.random.PRNGKey(1))
+
+    def sample_prior(prior_dtype: Optional[jnp.dtype]) -> np.ndarray:
+      enn = hypermodels.MLPHypermodelPriorIndependentLayers(
+          base_output_sizes=[2],
+          prior_scale=1.0,
+          dummy_input=dummy_input,
+          indexer=indexer,
+          prior_base_output_sizes=prior_hiddens + [2],
+          prior_dtype=prior_dtype)
+      params = enn.init(jax.random.PRNGKey(2), dummy_input, indices[0])
+      out = jax.vmap(enn.apply, in_axes=[None, None, 0])(
+          params, dummy_input, indices)
+      return out.prior
+
+    prior_samples = sample_prior(None)
+    low_precision_samples = sample_prior(jnp.bfloat16)
+    self.assertEqual(low_precision_samples.dtype, prior_samples.dtype)
+    np.testing.assert_allclose(
+        low_precision_samples.mean(axis=0), prior_samples.mean(axis=0),
+        atol=0.05)
+    np.testing.assert_allclose(
+        low_precision_samples.std(axis=0), prior_samples.std(axis=0),
+        rtol=0.05, atol=0.02)
+
+
+class PriorMLPIndependentLayersTest(parameterized.TestCase):
+
+  @parameterized.parameters([
+      ([3, 3, 3, 2], 8),
+      ([4, 4, 4, 4, 2], 2),
+      ([4, 4, 4, 4, 2], 11),
+      ([3, 5, 2], 6),
+  ])
+  def test_matches_layer_loop(self, output_sizes: List[int], index_dim: int):
+    """Make sure the prior matches forwarding each layer in a Python loop."""
+    num_layers = len(output_sizes)
+
+    def prior_net(x, z):
+      return hypermodels.PriorMLPIndependentLayers(
+          output_sizes, index_dim)(x, z)
+
+    transformed = hk.without_apply_rng(hk.transform(prior_net))
+    x = jax.random.normal(jax.random.PRNGKey(0), [10, 3])
+    z = jax.random.normal(jax.random.PRNGKey(1), [index_dim])
+    params = transformed.init(jax.random.PRNGKey(2), x, z)
+
+    if index_dim < num_layers:
+      index_layers = [z] * num_layers
+    else:
+      index_layers = np.array_split(z, num_layers)
+
+    expected = x
+    for i, index_layer in enumerate(index_layers):
+      suffix = f'_{i}' if i else ''
+      layer_params = params[f'prior_independent_layers/~/hyper_linear{suffix}']
+      weights = jnp.einsum('ohi,i->oh', layer_params['w'], index_layer)
+      bias = jnp.einsum('oi,i->o', layer_params['b'], index_layer)
+      expected = jnp.einsum('oh,bh->bo', weights, expected) + bias
+      if i < num_layers - 1:
+        expected = jax.nn.relu(expected)
+
+    np.testing.assert_allclose(
+        transformed.apply(params, x, z), expected, rtol=1e-5, atol=1e-5)
+
 
 if __name__ == '__main__':
   absltest.main()
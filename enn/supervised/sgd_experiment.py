@@ -18,13 +18,14 @@
 """An standard experiment operating by SGD."""
 
 import functools
-from typing import Dict, NamedTuple, Optional, Tuple
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple
 
 from acme.utils import loggers
 from enn import base
 from enn.supervised import base as supervised_base
 import haiku as hk
 import jax
+import jax.numpy as jnp
 import optax
 
 
@@ -38,6 +39,12 @@ class Experiment(supervised_base.BaseExperiment):
 
   Optional eval_datasets which is a collection of datasets to *evaluate*
   the loss on every eval_log_freq steps.
+
+  With n_jitted_steps > 1, that many SGD steps are run inside a single jitted
+  jax.lax.scan. This amortizes the dispatch overhead of each step but holds
+  n_jitted_steps batches on device at once, and evaluation within a group of
+  steps is done with the params at the end of the group. The trained params do
+  not depend on n_jitted_steps.
   """
 
   def __init__(self,
@@ -49,7 +56,8 @@ class Experiment(supervised_base.BaseExperiment):
                logger: Optional[loggers.Logger] = None,
                train_log_freq: int = 1,
                eval_datasets: Optional[Dict[str, base.BatchIterator]] = None,
-               eval_log_freq: int = 1):
+               eval_log_freq: int = 1,
+               n_jitted_steps: int = 1):
     self.enn = enn
     self.dataset = dataset
     self.rng = hk.PRNGSequence(seed)
@@ -87,6 +95,18 @@ class Experiment(supervised_base.BaseExperiment):
       return new_state, metrics
     self._sgd_step = jax.jit(sgd_step)
 
+    # Define n_jitted_steps of SGD in a single scan over stacked batches
+    def multi_sgd_step(
+        state: TrainingState,
+        batches: base.Batch,
+        keys: base.RngKey,
+    ) -> Tuple[TrainingState, base.LossMetrics]:
+      def step_fn(state, batch_and_key):
+        return sgd_step(state, *batch_and_key)
+      return jax.lax.scan(step_fn, state, (batches, keys))
+    self._multi_sgd_step = jax.jit(multi_sgd_step)
+    self._n_jitted_steps = n_jitted_steps
+
     # Initialize networks
     batch = next(self.dataset)
     index = self.enn.indexer(next(self.rng))
@@ -100,29 +120,61 @@ class Experiment(supervised_base.BaseExperiment):
 
   def train(self, num_batches: int):
     """Train the ENN for num_batches."""
-    for _ in range(num_batches):
-      self.step += 1
+    if self._n_jitted_steps > 1:
+      num_groups, num_single_steps = divmod(num_batches, self._n_jitted_steps)
+    else:
+      num_groups, num_single_steps = 0, num_batches
+
+    for _ in range(num_groups):
+      # Keys are drawn in the same order as for single steps, so that jitting
+      # steps together does not change the training result.
+      batches, keys, eval_keys = [], [], []
+      for i in range(self._n_jitted_steps):
+        batches.append(next(self.dataset))
+        keys.append(next(self.rng))
+        eval_keys.append(self._next_eval_keys(self.step + i + 1))
+      self.state, loss_metrics = self._multi_sgd_step(
+          self.state,
+          jax.tree_multimap(lambda *x: jnp.stack(x), *batches),
+          jnp.stack(keys))
+      for i in range(self._n_jitted_steps):
+        self._log_step({k: v[i] for k, v in loss_metrics.items()},
+                       eval_keys[i])
+
+    for _ in range(num_single_steps):
       self.state, loss_metrics = self._sgd_step(
           self.state, next(self.dataset), next(self.rng))
-
-      # Periodically log this performance as dataset=train.
-      if self.step % self._train_log_freq == 0:
-        loss_metrics.update(
-            {'dataset': 'train', 'step': self.step, 'sgd': True})
-        self.logger.write(loss_metrics)
-
-      # Periodically evaluate the other datasets.
-      if self._eval_datasets and self.step % self._eval_log_freq == 0:
-        for name, dataset in self._eval_datasets.items():
-          loss, metrics = self._loss(
-              self.state.params, next(dataset), next(self.rng))
-          metrics.update({
-              'dataset': name,
-              'step': self.step,
-              'sgd': False,
-              'loss': loss,
-          })
-          self.logger.write(metrics)
+      self._log_step(loss_metrics, self._next_eval_keys(self.step + 1))
+
+  def _next_eval_keys(self, step: int) -> Sequence[base.RngKey]:
+    """Draws one key per eval dataset if they are evaluated at this step."""
+    if self._eval_datasets and step % self._eval_log_freq == 0:
+      return [next(self.rng) for _ in self._eval_datasets]
+    return []
+
+  def _log_step(self,
+                loss_metrics: base.LossMetrics,
+                eval_keys: Sequence[base.RngKey]):
+    """Increments the step and logs train/eval performance periodically."""
+    self.step += 1
+
+    # Periodically log this performance as dataset=train.
+    if self.step % self._train_log_freq == 0:
+      loss_metrics.update(
+          {'dataset': 'train', 'step': self.step, 'sgd': True})
+      self.logger.write(loss_metrics)
+
+    # Periodically evaluate the other datasets, eval_keys is empty otherwise.
+    if eval_keys:
+      for (name, dataset), key in zip(self._eval_datasets.items(), eval_keys):
+        loss, metrics = self._loss(self.state.params, next(dataset), key)
+        metrics.update({
+            'dataset': name,
+            'step': self.step,
+            'sgd': False,
+            'loss': loss,
+        })
+        self.logger.write(metrics)
 
   def predict(self, inputs: base.Array, seed: int) -> base.Array:
     """Evaluate the trained model at given inputs."""
@@ -17,6 +17,7 @@
 
 """Tests for enn.supervised.sgd_experiment."""
 
+import functools
 import itertools
 
 from absl.testing import absltest
@@ -25,6 +26,8 @@ from enn import losses
 from enn import networks
 from enn import utils
 from enn.supervised.sgd_experiment import Experiment
+import jax
+import numpy as np
 import optax
 
 
@@ -59,6 +62,25 @@ class ExperimentTest(parameterized.TestCase):
         initial_loss, final_loss,
         f'final loss {final_loss} is greater than initial loss {initial_loss}')
 
+  @parameterized.parameters([2, 3])
+  def test_n_jitted_steps(self, n_jitted_steps: int):
+    """Make sure jitting multiple steps together gives the same params."""
+    enn = networks.MLPEnsembleEnn(output_sizes=[8, 8, 1], num_ensemble=5)
+    loss_fn = losses.average_single_index_loss(losses.L2Loss(),
+                                               num_index_samples=10)
+    params = []
+    for n in [1, n_jitted_steps]:
+      experiment = Experiment(
+          enn, loss_fn, optax.adam(1e-3), utils.make_test_data(100),
+          eval_datasets={'eval': utils.make_test_data(100)},
+          eval_log_freq=2, n_jitted_steps=n)
+      experiment.train(10)
+      self.assertEqual(experiment.step, 10)
+      params.append(experiment.state.params)
+    jax.tree_multimap(
+        functools.partial(np.testing.assert_allclose, rtol=1e-5, atol=1e-6),
+        *params)
+
 
 if __name__ == '__main__':
   absltest.main()